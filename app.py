@@ -1,30 +1,69 @@
-import logging
-from typing import Iterable, Tuple, Dict, List
+import functools
+import secrets
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import quote
 
 import httpx
-from fastapi import FastAPI, Request, Response
+import jinja2
+import orjson
+import xxhash
+from markupsafe import escape
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import HTMLResponse, PlainTextResponse
 
 from config import settings
+from proxy import (
+    DEFAULT_AUTH_PARAMS,
+    PAGES_URL,
+    POSTS_URL,
+    copy_cache_headers,
+    fetch,
+    invalidate,
+    merge_query_params,
+    proxy_get,
+    purge_cache,
+)
 
 # ========= Config =========
-BUTTER_API_TOKEN = settings.get_butter_token() or ""
 BUTTER_BASE_URL = settings.BUTTER_BASE_URL
-BUTTER_V2 = settings.BUTTER_V2
 TIMEOUT = httpx.Timeout(settings.REQUEST_TIMEOUT, read=settings.READ_TIMEOUT)
+LIMITS = httpx.Limits(
+    max_connections=settings.MAX_CONNECTIONS,
+    max_keepalive_connections=settings.MAX_KEEPALIVE,
+    keepalive_expiry=settings.KEEPALIVE_EXPIRY,
+)
 
-if not BUTTER_API_TOKEN:
-    logging.warning("BUTTER_API_TOKEN no está definido. Configúralo en el entorno.")
 
 # ========= App =========
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Seguir redirecciones (evita 301 por slash final)
+    # Keep-alive largo + HTTP/2 para multiplexar peticiones sobre una sola conexión TLS
+    app.state.http = httpx.AsyncClient(
+        timeout=TIMEOUT,
+        base_url=BUTTER_BASE_URL,
+        follow_redirects=True,
+        limits=LIMITS,
+        http2=True,
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
 app = FastAPI(
     title=settings.APP_TITLE, 
     version=settings.APP_VERSION,
-    description=settings.APP_DESCRIPTION
+    description=settings.APP_DESCRIPTION,
+    lifespan=lifespan,
 )
 
-# CORS abierto a todos (como pediste)
+# CORS limitado a los orígenes de CORS_ORIGINS
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.ALLOWED_ORIGINS,
@@ -33,86 +72,141 @@ app.add_middleware(
     allow_methods=settings.ALLOWED_METHODS,
 )
 
-# Seguir redirecciones (evita 301 por slash final)
-client = httpx.AsyncClient(
-    timeout=TIMEOUT, base_url=BUTTER_BASE_URL, follow_redirects=True
-)
-UPSTREAM_CACHE_HEADERS = {"cache-control", "etag", "last-modified", "expires"}
-
-
-def _merge_query_params(original: Iterable[Tuple[str, str]]) -> Dict[str, List[str]]:
-    merged: Dict[str, List[str]] = {}
-    for k, v in original:
-        if k.lower() == "auth_token":
-            continue
-        merged.setdefault(k, []).append(v)
-    merged["auth_token"] = [BUTTER_API_TOKEN]
-    return merged
-
-
-def _copy_cache_headers(upstream_headers: httpx.Headers, response: Response):
-    for h in UPSTREAM_CACHE_HEADERS:
-        if h in upstream_headers:
-            response.headers[h] = upstream_headers[h]
-
-
-async def _proxy_get(
-    path: str, params: Iterable[Tuple[str, str]], response: Response
-) -> Response:
-    qp = _merge_query_params(params)
-    # Normaliza con slash final para evitar 301
-    norm = path.lstrip("/").rstrip("/") + "/"
-    url = f"{BUTTER_V2}/{norm}"
-    upstream = await client.get(url, params=qp)
-    _copy_cache_headers(upstream.headers, response)
-    ctype = upstream.headers.get("content-type", "")
-    response.status_code = upstream.status_code
-    if "application/json" in ctype.lower():
-        return Response(
-            content=upstream.content,
-            media_type="application/json",
-            status_code=upstream.status_code,
-        )
-    return Response(
-        content=upstream.text,
-        media_type=ctype or "text/plain",
-        status_code=upstream.status_code,
+ETAG_MAX_BODY = 1024 * 1024
+GZIP_MIN_SIZE = 512
+ETAG_CONTENT_TYPES = ("application/json", "text/html")
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Comparación débil (RFC 9110): se ignora el prefijo W/
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == bare for tag in if_none_match.split(",")
     )
 
 
+def _not_modified_since(if_modified_since: str, last_modified: Optional[str]) -> bool:
+    if not last_modified:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(
+            if_modified_since
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+@app.middleware("http")
+async def etag_middleware(request: Request, call_next):
+    """Añade ETag a respuestas GET y devuelve 304 si el cliente ya las tiene
+
+    Valida tanto `If-None-Match` como `If-Modified-Since` (contra `Last-Modified`).
+    """
+    response = await call_next(request)
+    if request.method != "GET" or response.status_code != 200:
+        return response
+    ctype = response.headers.get("content-type", "")
+    length = response.headers.get("content-length")
+    if not ctype.startswith(ETAG_CONTENT_TYPES) or length is None:
+        return response
+    if int(length) > ETAG_MAX_BODY:
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    # Si ButterCMS ya mandó ETag se respeta; si no, se calcula sobre el cuerpo
+    etag = response.headers.get("etag") or f'W/"{xxhash.xxh3_64_hexdigest(body)}"'
+    if len(body) >= GZIP_MIN_SIZE and not etag.startswith("W/"):
+        # Gzip cambia los bytes: un ETag fuerte no puede valer para ambas codificaciones
+        etag = f"W/{etag}"
+    # If-Modified-Since sólo cuenta si no hay If-None-Match (RFC 9110 13.1.3)
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match:
+        fresh = _etag_matches(if_none_match, etag)
+    elif if_modified_since:
+        fresh = _not_modified_since(
+            if_modified_since, response.headers.get("last-modified")
+        )
+    else:
+        fresh = False
+    if fresh:
+        not_modified = Response(status_code=304)
+        # Mismas cabeceras de caché que tendría el 200, incluido el Age de la caché
+        not_modified.raw_headers.extend(copy_cache_headers(response.raw_headers))
+        age = response.headers.get("age")
+        if age is not None:
+            not_modified.headers["age"] = age
+        not_modified.headers["etag"] = etag
+        return not_modified
+    buffered = Response(content=body, status_code=response.status_code)
+    buffered.raw_headers = list(response.raw_headers)
+    buffered.headers["etag"] = etag
+    return buffered
+
+
+# Se registra después del ETag para quedar por fuera: los 304 no llegan a comprimirse
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE, compresslevel=5)
+
+
 # ========= Meta =========
 @app.get("/health", tags=["meta"])
-async def health():
+async def health() -> Dict[str, str]:
     return {"status": "ok"}
 
 
+def _require_admin(x_admin_token: str = Header(default="")):
+    if not settings.ADMIN_TOKEN or not secrets.compare_digest(
+        x_admin_token, settings.ADMIN_TOKEN
+    ):
+        raise HTTPException(status_code=403, detail="Token de administración inválido")
+
+
+# Ambos endpoints sólo limpian la caché de este worker; en los demás, el contenido
+# antiguo dura como mucho el TTL (max-age de ButterCMS o settings.CACHE_TTL)
+@app.post("/cache/purge", tags=["meta"], dependencies=[Depends(_require_admin)])
+async def cache_purge() -> Dict[str, int]:
+    _render_post.cache_clear()
+    return {"purged": purge_cache()}
+
+
+@app.post(
+    "/admin/invalidate/{slug:path}",
+    tags=["meta"],
+    dependencies=[Depends(_require_admin)],
+)
+async def invalidate_post(slug: str) -> Dict[str, int]:
+    # El listado también muestra título y resumen del post
+    purged = invalidate(_post_url(slug)) + invalidate(POSTS_URL)
+    _render_post.cache_clear()
+    return {"purged": purged}
+
+
 # ========= Proxy ButterCMS (JSON 1:1) =========
 @app.get("/v2/posts", tags=["posts"])
-async def list_posts(request: Request, response: Response):
-    return await _proxy_get("posts", request.query_params.multi_items(), response)
+async def list_posts(request: Request):
+    return await proxy_get(POSTS_URL, request, request.query_params.multi_items())
 
 
 @app.get("/v2/posts/{slug}", tags=["posts"])
-async def get_post(slug: str, request: Request, response: Response):
-    return await _proxy_get(
-        f"posts/{slug}", request.query_params.multi_items(), response
+async def get_post(slug: str, request: Request):
+    return await proxy_get(
+        f"{POSTS_URL}{slug}/", request, request.query_params.multi_items()
     )
 
 
 @app.get("/v2/pages/{page_type}", tags=["pages"])
-async def get_pages_by_type(page_type: str, request: Request, response: Response):
-    return await _proxy_get(
-        f"pages/{page_type}", request.query_params.multi_items(), response
+async def get_pages_by_type(page_type: str, request: Request):
+    return await proxy_get(
+        f"{PAGES_URL}{page_type}/", request, request.query_params.multi_items()
     )
 
 
 @app.get("/v2/pages/{page_type}/{slug}", tags=["pages"])
-async def get_page_by_type_and_slug(
-    page_type: str, slug: str, request: Request, response: Response
-):
+async def get_page_by_type_and_slug(page_type: str, slug: str, request: Request):
     items = list(request.query_params.multi_items())
     items.append(("slug", slug))
-    return await _proxy_get(f"pages/{page_type}", items, response)
+    return await proxy_get(f"{PAGES_URL}{page_type}/", request, items)
 
 
 # ========= HTML sencillo para blogs =========
@@ -401,37 +495,43 @@ HTML_BASE_CSS = """
 """
 
 
-def _html_shell(title: str, body: str) -> str:
-    return f"""<!doctype html>
-<html lang=\"es\">
+# Shell HTML precalculado en bytes: sólo título y cuerpo cambian por petición
+_SHELL_HEAD = b"""<!doctype html>
+<html lang="es">
 <head>
-<meta charset=\"utf-8\" />
-<meta name=\"viewport\" content=\"width=device-width,initial-scale=1\" />
-<title>{title}</title>
+<meta charset="utf-8" />
+<meta name="viewport" content="width=device-width,initial-scale=1" />
+<title>"""
+_SHELL_MIDDLE = ("""</title>
 <link rel="preconnect" href="https://fonts.googleapis.com">
 <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
 <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700;800&display=swap" rel="stylesheet">
-{HTML_BASE_CSS}
+""" + HTML_BASE_CSS + """
 </head>
 <body>
 <header>
-  <div class=\"header-content\">
-    <div class=\"logo\">🧸 Nannyfy</div>
-    <nav class=\"nav-links\">
-      <a href=\"/\">Inicio</a>
-      <a href=\"/blog\">Blog</a>
+  <div class="header-content">
+    <div class="logo">🧸 Nannyfy</div>
+    <nav class="nav-links">
+      <a href="/">Inicio</a>
+      <a href="/blog">Blog</a>
     </nav>
   </div>
 </header>
-<main class=\"wrap\">{body}</main>
+<main class="wrap">""").encode()
+_SHELL_TAIL = """</main>
 <footer>© 2025 Nannyfy • Tu plataforma de cuidado infantil de confianza • Powered by FastAPI</footer>
 </body>
-</html>"""
+</html>""".encode()
 
 
-@app.get("/", response_class=HTMLResponse, tags=["html"])
-async def root():
-    body = '''
+def _html_page(title: str, body: str) -> bytes:
+    return b"".join(
+        [_SHELL_HEAD, escape(title).encode(), _SHELL_MIDDLE, body.encode(), _SHELL_TAIL]
+    )
+
+
+HOME_TMPL = """
     <div class="hero">
       <h1>🧸 Bienvenido a Nannyfy</h1>
       <p>Tu plataforma de confianza para encontrar el cuidado infantil perfecto</p>
@@ -453,83 +553,143 @@ async def root():
         <a class="btn secondary" href="/blog">Descubre cómo</a>
       </div>
     </div>
-    '''
-    return HTMLResponse(_html_shell("Nannyfy - Cuidado Infantil de Confianza", body))
+"""
+
+BLOG_TMPL = """
+<div class="grid">
+{%- for p in posts %}
+        <div class="card">
+          <h2 class="title"><a href="/blog/{{ (p.slug or "") | slug_url }}">{{ p.title or "Sin título" }}</a></h2>
+          <div class="meta">Publicado el {{ (p.published or "")[:10] }}</div>
+          <p class="desc">{{ p.summary or "" }}</p>
+          <a class="btn" href="/blog/{{ (p.slug or "") | slug_url }}">📖 Leer artículo</a>
+        </div>
+{%- else %}
+<div class="card"><h2 class="title">📝 No hay artículos disponibles</h2><p class="desc">Pronto tendremos contenido interesante sobre cuidado infantil.</p></div>
+{%- endfor %}
+</div>
+    <nav class="pager">
+      <a class="btn" {% if not previous_page %}disabled{% endif %} href="/blog{% if previous_page %}?page={{ curr - 1 }}&page_size={{ page_size }}{% endif %}">← Anterior</a>
+      <span class="page-indicator">Página {{ curr }}</span>
+      <a class="btn" {% if not next_page %}disabled{% endif %} href="/blog{% if next_page %}?page={{ curr + 1 }}&page_size={{ page_size }}{% endif %}">Siguiente →</a>
+    </nav>
+"""
+
+POST_TMPL = """
+    <article>
+      <h1>{{ title }}</h1>
+      <div class="meta">📅 Publicado el {{ published }}</div>
+      <div class="content">{{ body_html | safe }}</div>
+      <p><a class="btn secondary" href="/blog">← Volver al blog</a></p>
+    </article>
+"""
+
+# Plantillas compiladas una sola vez; autoescape evita inyectar HTML desde ButterCMS
+_env = jinja2.Environment(
+    loader=jinja2.DictLoader(
+        {
+            "home.html": HOME_TMPL,
+            "blog.html": BLOG_TMPL,
+            "post.html": POST_TMPL,
+        }
+    ),
+    autoescape=True,
+    auto_reload=False,
+    cache_size=-1,
+)
+# A diferencia de `urlencode`, codifica también "/" para que el slug sea un solo segmento
+_env.filters["slug_url"] = functools.partial(quote, safe="")
+_blog_template = _env.get_template("blog.html")
+_post_template = _env.get_template("post.html")
+# La portada es estática: se renderiza al importar
+_home_page = _html_page(
+    "Nannyfy - Cuidado Infantil de Confianza", _env.get_template("home.html").render()
+)
+
+
+@app.get("/", response_class=HTMLResponse, tags=["html"])
+async def root():
+    return HTMLResponse(_home_page)
+
+
+def _int_param(raw: Optional[str], default: int, low: int, high: Optional[int]) -> int:
+    try:
+        value = int(raw) if raw is not None else default
+    except ValueError:
+        value = default
+    value = max(value, low)
+    return min(value, high) if high is not None else value
 
 
 @app.get("/blog", response_class=HTMLResponse, tags=["html"])
 async def blog_index(request: Request):
-    page = request.query_params.get("page", "1")
-    page_size = request.query_params.get("page_size", "9")
-    params = [("page", page), ("page_size", page_size)]
-    qp = _merge_query_params(params)
-    # Asegura slash final para evitar 301
-    r = await client.get(f"{BUTTER_V2}/posts/", params=qp)
+    # Sólo enteros acotados: se reenvían a ButterCMS y se reflejan en los enlaces
+    curr = _int_param(request.query_params.get("page"), 1, 1, None)
+    page_size = _int_param(
+        request.query_params.get("page_size"),
+        settings.DEFAULT_PAGE_SIZE,
+        1,
+        settings.MAX_PAGE_SIZE,
+    )
+    params = [("page", str(curr)), ("page_size", str(page_size))]
+    qp = merge_query_params(params)
+    r = await fetch(request, POSTS_URL, qp)
     if r.status_code != 200:
         return PlainTextResponse(
             f"Error al cargar posts ({r.status_code})", status_code=r.status_code
         )
-    data = r.json()
-    posts = data.get("data", [])
+    data = orjson.loads(r.content)
     meta = data.get("meta", {}) or {}
-    next_page = meta.get("next_page")
-    previous_page = meta.get("previous_page")
-    cards = []
-    for p in posts:
-        slug = p.get("slug", "")
-        title = p.get("title", "Sin título")
-        summary = p.get("summary") or ""
-        published = (p.get("published") or "")[:10]
-        cards.append(f"""
-        <div class=\"card\">
-          <h2 class=\"title\"><a href=\"/blog/{slug}\">{title}</a></h2>
-          <div class=\"meta\">Publicado el {published}</div>
-          <p class=\"desc\">{summary}</p>
-          <a class=\"btn\" href=\"/blog/{slug}\">📖 Leer artículo</a>
-        </div>
-        """)
-    grid = f'<div class="grid">{"".join(cards) or "<div class=\"card\"><h2 class=\"title\">📝 No hay artículos disponibles</h2><p class=\"desc\">Pronto tendremos contenido interesante sobre cuidado infantil.</p></div>"}</div>'
-    try:
-        curr = int(page)
-    except Exception:
-        curr = 1
-    prev_q = f"?page={curr - 1}&page_size={page_size}" if previous_page else ""
-    next_q = f"?page={curr + 1}&page_size={page_size}" if next_page else ""
-    pager = f"""
-    <nav class=\"pager\">
-      <a class=\"btn\" {"disabled" if not previous_page else ""} href=\"/blog{prev_q}\">← Anterior</a>
-      <span class=\"page-indicator\">Página {curr}</span>
-      <a class=\"btn\" {"disabled" if not next_page else ""} href=\"/blog{next_q}\">Siguiente →</a>
-    </nav>
-    """
-    body = grid + pager
-    return HTMLResponse(_html_shell("Nannyfy • Blog de Crianza y Cuidado Infantil", body))
+    body = _blog_template.render(
+        posts=data.get("data", []),
+        curr=curr,
+        next_page=meta.get("next_page"),
+        previous_page=meta.get("previous_page"),
+        page_size=page_size,
+    )
+    return HTMLResponse(
+        _html_page("Nannyfy • Blog de Crianza y Cuidado Infantil", body)
+    )
+
+
+# La clave incluye el JSON del upstream: cuando la caché TTL lo renueva, se re-renderiza
+@functools.lru_cache(maxsize=settings.POST_CACHE_SIZE)
+def _render_post(slug: str, post_json: bytes) -> bytes:
+    post = orjson.loads(post_json).get("data", {})
+    title = post.get("title", "Sin título")
+    body = _post_template.render(
+        title=title,
+        published=(post.get("published") or "")[:10],
+        body_html=post.get("body") or "<p>Sin contenido.</p>",
+    )
+    return _html_page(f"Nannyfy • {title}", body)
 
 
-@app.get("/blog/{slug}", response_class=HTMLResponse, tags=["html"])
+def _post_url(slug: str) -> str:
+    # El slug viaja como un único segmento, aunque contenga "/"
+    return f"{POSTS_URL}{quote(slug, safe='')}/"
+
+
+# `:path` porque Starlette enruta sobre la ruta ya decodificada (%2F -> "/")
+@app.get("/blog/{slug:path}", response_class=HTMLResponse, tags=["html"])
 async def blog_post(slug: str, request: Request):
-    qp = _merge_query_params([])
-    # Asegura slash final para evitar 301
-    r = await client.get(f"{BUTTER_V2}/posts/{slug}/", params=qp)
+    r = await fetch(request, _post_url(slug), DEFAULT_AUTH_PARAMS)
     if r.status_code != 200:
         return PlainTextResponse(
             f"Post no encontrado ({r.status_code})", status_code=r.status_code
         )
-    post = r.json().get("data", {})
-    title = post.get("title", "Sin título")
-    published = (post.get("published") or "")[:10]
-    body_html = post.get("body") or "<p>Sin contenido.</p>"
-    html = f"""
-    <article>
-      <h1>{title}</h1>
-      <div class=\"meta\">📅 Publicado el {published}</div>
-      <div class=\"content\">{body_html}</div>
-      <p><a class=\"btn secondary\" href=\"/blog\">← Volver al blog</a></p>
-    </article>
-    """
-    return HTMLResponse(_html_shell(f"Nannyfy • {title}", html))
+    return HTMLResponse(_render_post(slug, r.content))
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    await client.aclose()
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop + httptools: bucle de eventos y parser HTTP en C
+    uvicorn.run(
+        "app:app",
+        host=settings.HOST,
+        port=settings.PORT,
+        loop="uvloop",
+        http="httptools",
+        workers=settings.WORKERS,
+    )
@@ -17,8 +17,20 @@ class Settings:
     APP_VERSION: str = "2.0.0"
     APP_DESCRIPTION: str = "Plataforma moderna de cuidado infantil con blog integrado"
     
+    # Servidor (sólo al arrancar con `python app.py`)
+    HOST: str = os.getenv("HOST", "0.0.0.0")
+    PORT: int = int(os.getenv("PORT", "8000"))
+    WORKERS: int = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+    
     # CORS Configuration
-    ALLOWED_ORIGINS: list = ["*"]
+    # Orígenes explícitos: con credenciales el navegador rechaza "*"
+    ALLOWED_ORIGINS: list = [
+        origin.strip()
+        for origin in os.getenv(
+            "CORS_ORIGINS", "https://nannyfy.com,https://www.nannyfy.com"
+        ).split(",")
+        if origin.strip()
+    ]
     ALLOWED_METHODS: list = ["*"]
     ALLOWED_HEADERS: list = ["*"]
     ALLOW_CREDENTIALS: bool = True
@@ -27,6 +39,19 @@ class Settings:
     REQUEST_TIMEOUT: float = 20.0
     READ_TIMEOUT: float = 30.0
     
+    # Pool de conexiones hacia ButterCMS (ajustable por entorno)
+    MAX_CONNECTIONS: int = int(os.getenv("MAX_CONNECTIONS", "1000"))
+    MAX_KEEPALIVE: int = int(os.getenv("MAX_KEEPALIVE", "100"))
+    KEEPALIVE_EXPIRY: float = float(os.getenv("KEEPALIVE_EXPIRY", "75.0"))
+    
+    # Caché en memoria de respuestas de ButterCMS
+    CACHE_TTL: float = float(os.getenv("CACHE_TTL", "60"))
+    CACHE_MAX_SIZE: int = int(os.getenv("CACHE_MAX_SIZE", "1024"))
+    POST_CACHE_SIZE: int = int(os.getenv("POST_CACHE_SIZE", "256"))
+    
+    # Token para endpoints de administración (vacío = deshabilitados)
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")
+    
     # Pagination defaults
     DEFAULT_PAGE_SIZE: int = 9
     MAX_PAGE_SIZE: int = 50
@@ -0,0 +1,320 @@
+"""
+Proxy hacia ButterCMS: inyección del token, caché en memoria y coalescencia de peticiones
+"""
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Iterable, Tuple, Dict, List, NamedTuple, Optional, Set, Union
+
+import httpx
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from config import settings
+
+BUTTER_API_TOKEN = settings.get_butter_token() or ""
+BUTTER_V2 = settings.BUTTER_V2
+
+# Compartido entre peticiones sin query: no debe mutarse
+DEFAULT_AUTH_PARAMS: Dict[str, List[str]] = {"auth_token": [BUTTER_API_TOKEN]}
+# URLs precalculadas (con slash final para evitar 301)
+POSTS_URL = f"{BUTTER_V2}/posts/"
+PAGES_URL = f"{BUTTER_V2}/pages/"
+
+if not BUTTER_API_TOKEN:
+    logging.warning("BUTTER_API_TOKEN no está definido. Configúralo en el entorno.")
+
+UPSTREAM_CACHE_HEADERS = {b"cache-control", b"etag", b"last-modified", b"expires"}
+# GET condicional del cliente; sólo se reenvía si la respuesta no es cacheable
+# (las cacheables se revalidan con los validadores guardados)
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since")
+# Respuestas no cacheables mayores que esto se reenvían en streaming
+STREAM_MIN_SIZE = 16 * 1024
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+CacheKey = Tuple[str, Tuple[Tuple[str, Tuple[str, ...]], ...]]
+
+
+class CachedResponse(NamedTuple):
+    status_code: int
+    content: bytes
+    content_type: str
+    headers: List[Tuple[bytes, bytes]]
+
+
+FetchResult = Union[CachedResponse, httpx.Response]
+
+# Caché en memoria (LRU): clave -> (expiración, instante de generación, respuesta)
+_cache: "OrderedDict[CacheKey, Tuple[float, float, CachedResponse]]" = OrderedDict()
+# Llamadas al upstream en curso, por clave de caché
+_inflight: "Dict[CacheKey, asyncio.Future[FetchResult]]" = {}
+# Cierres de streams huérfanos: se guarda la referencia hasta que terminan
+_pending_closes: "Set[asyncio.Future[None]]" = set()
+
+
+def merge_query_params(original: Iterable[Tuple[str, str]]) -> Dict[str, List[str]]:
+    merged: Dict[str, List[str]] = {}
+    for k, v in original:
+        if k.lower() == "auth_token":
+            continue
+        values = merged.get(k)
+        if values is None:
+            merged[k] = [v]
+        else:
+            values.append(v)
+    if not merged:
+        return DEFAULT_AUTH_PARAMS
+    merged["auth_token"] = DEFAULT_AUTH_PARAMS["auth_token"]
+    return merged
+
+
+def copy_cache_headers(
+    raw_headers: Iterable[Tuple[bytes, bytes]],
+) -> List[Tuple[bytes, bytes]]:
+    # Una pasada sobre las cabeceras crudas, sin decodificar a str
+    return [
+        (k.lower(), v) for k, v in raw_headers if k.lower() in UPSTREAM_CACHE_HEADERS
+    ]
+
+
+def _media_type(ctype: str) -> str:
+    if "application/json" in ctype.lower():
+        return "application/json"
+    return ctype or "text/plain"
+
+
+def _cache_key(url: str, qp: Dict[str, List[str]]) -> CacheKey:
+    # El token nunca forma parte de la clave
+    return (
+        url,
+        tuple(sorted((k, tuple(v)) for k, v in qp.items() if k != "auth_token")),
+    )
+
+
+def _cache_ttl(upstream_headers: httpx.Headers) -> float:
+    """TTL según Cache-Control del upstream; `settings.CACHE_TTL` si no lo indica"""
+    cache_control = upstream_headers.get("cache-control", "").lower()
+    if any(d in cache_control for d in ("no-store", "no-cache", "private")):
+        return 0
+    match = _MAX_AGE_RE.search(cache_control)
+    if match:
+        # Lo que ya lleva en cachés intermedias se descuenta del max-age
+        return float(match.group(1)) - _upstream_age(upstream_headers)
+    return settings.CACHE_TTL
+
+
+def _upstream_age(upstream_headers: httpx.Headers) -> float:
+    try:
+        return max(float(upstream_headers.get("age", "0")), 0.0)
+    except ValueError:
+        return 0.0
+
+
+async def _fetch_upstream(
+    client: httpx.AsyncClient,
+    url: str,
+    qp: Dict[str, List[str]],
+    key: CacheKey,
+    stream: bool,
+    headers: Optional[Dict[str, str]] = None,
+    stale: Optional[CachedResponse] = None,
+) -> FetchResult:
+    """GET a ButterCMS; con `stream`, las respuestas grandes no cacheables no se leen
+
+    Con `stale` (entrada caducada) se revalida con sus validadores: si ButterCMS
+    responde 304 se reutiliza el cuerpo guardado y se renueva su TTL.
+    """
+    if stale is not None:
+        headers = _validators(stale.headers)
+    upstream = await client.send(
+        client.build_request("GET", url, params=qp, headers=headers), stream=True
+    )
+    try:
+        if stale is not None and upstream.status_code == 304:
+            await upstream.aclose()
+            return _revalidated(key, stale, upstream.headers)
+        ttl = _cache_ttl(upstream.headers)
+        cacheable = upstream.status_code == 200 and ttl > 0
+        length = upstream.headers.get("content-length")
+        if (
+            stream
+            and not cacheable
+            and upstream.status_code not in (204, 304)
+            and (length is None or int(length) > STREAM_MIN_SIZE)
+        ):
+            if stale is not None:
+                _cache.pop(key, None)
+            return upstream
+        content = await upstream.aread()
+    except BaseException:
+        await upstream.aclose()
+        raise
+    await upstream.aclose()
+    entry = CachedResponse(
+        status_code=upstream.status_code,
+        content=content,
+        content_type=upstream.headers.get("content-type", ""),
+        headers=copy_cache_headers(upstream.headers.raw),
+    )
+    if cacheable:
+        _store(key, entry, ttl, _upstream_age(upstream.headers))
+    elif stale is not None:
+        _cache.pop(key, None)
+    return entry
+
+
+def _store(key: CacheKey, entry: CachedResponse, ttl: float, age: float):
+    now = time.monotonic()
+    _cache[key] = (now + ttl, now - age, entry)
+    _cache.move_to_end(key)
+    while len(_cache) > settings.CACHE_MAX_SIZE:
+        _cache.popitem(last=False)
+
+
+def _validators(
+    cached_headers: List[Tuple[bytes, bytes]],
+) -> Optional[Dict[str, str]]:
+    headers = {}
+    for k, v in cached_headers:
+        if k == b"etag":
+            headers["if-none-match"] = v.decode("latin-1")
+        elif k == b"last-modified":
+            headers["if-modified-since"] = v.decode("latin-1")
+    return headers or None
+
+
+def _revalidated(
+    key: CacheKey, stale: CachedResponse, upstream_headers: httpx.Headers
+) -> CachedResponse:
+    # Las cabeceras de caché del 304 sustituyen a las guardadas
+    merged = httpx.Headers(stale.headers)
+    for k, v in copy_cache_headers(upstream_headers.raw):
+        merged[k.decode("latin-1")] = v.decode("latin-1")
+    if "age" in upstream_headers:
+        merged["age"] = upstream_headers["age"]
+    entry = stale._replace(headers=copy_cache_headers(merged.raw))
+    ttl = _cache_ttl(merged)
+    if ttl > 0:
+        _store(key, entry, ttl, _upstream_age(merged))
+    else:
+        _cache.pop(key, None)
+    return entry
+
+
+def _close_if_stream(task: "asyncio.Future[FetchResult]"):
+    if not task.cancelled() and task.exception() is None:
+        result = task.result()
+        if isinstance(result, httpx.Response):
+            closing = asyncio.ensure_future(result.aclose())
+            _pending_closes.add(closing)
+            closing.add_done_callback(_pending_closes.discard)
+
+
+def _conditional_headers(request: Request) -> Optional[Dict[str, str]]:
+    headers = {h: request.headers[h] for h in CONDITIONAL_HEADERS if h in request.headers}
+    return headers or None
+
+
+async def fetch(
+    request: Request,
+    url: str,
+    qp: Dict[str, List[str]],
+    stream: bool = False,
+    conditional: bool = False,
+) -> FetchResult:
+    """GET a ButterCMS pasando por la caché en memoria"""
+    key = _cache_key(url, qp)
+    hit = _cache.get(key)
+    now = time.monotonic()
+    if hit is not None and hit[0] > now:
+        _cache.move_to_end(key)
+        # Age para que el cliente descuente el tiempo pasado en esta caché
+        entry = hit[2]
+        age = str(int(now - hit[1])).encode()
+        return entry._replace(headers=entry.headers + [(b"age", age)])
+    # Entrada caducada: la petición compartida la revalida contra ButterCMS
+    stale = hit[2] if hit is not None else None
+    client = request.app.state.http
+    # Peticiones idénticas concurrentes comparten una sola llamada al upstream
+    task = _inflight.get(key)
+    owner = task is None
+    if task is None:
+        task = asyncio.ensure_future(
+            _fetch_upstream(client, url, qp, key, stream, stale=stale)
+        )
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: si un cliente cancela, los demás siguen esperando el resultado
+    try:
+        result = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if owner:
+            task.add_done_callback(_close_if_stream)
+        raise
+    if isinstance(result, httpx.Response):
+        # Respuesta no cacheable en streaming: sólo la consume quien la abrió, y sin el
+        # GET condicional del cliente. Si el cliente lo envió (sea quien abrió la
+        # petición o no), se repite con sus cabeceras por si ButterCMS da 304
+        fwd_headers = _conditional_headers(request) if conditional else None
+        if owner and fwd_headers is None:
+            return result
+        if owner:
+            await result.aclose()
+        return await _fetch_upstream(client, url, qp, key, stream, fwd_headers)
+    return result
+
+
+async def fetch_many(
+    request: Request, urls_and_params: Iterable[Tuple[str, Dict[str, List[str]]]]
+) -> List[FetchResult]:
+    """Varios `fetch` en paralelo: la latencia total es la del más lento"""
+    return list(
+        await asyncio.gather(*(fetch(request, url, qp) for url, qp in urls_and_params))
+    )
+
+
+async def proxy_get(
+    url: str, request: Request, params: Iterable[Tuple[str, str]]
+) -> Response:
+    """Reenvía a `url`, que ya debe venir con slash final (ver POSTS_URL/PAGES_URL)"""
+    qp = merge_query_params(params)
+    result = await fetch(request, url, qp, stream=True, conditional=True)
+    if isinstance(result, httpx.Response):
+        response: Response = StreamingResponse(
+            result.aiter_bytes(),
+            status_code=result.status_code,
+            media_type=_media_type(result.headers.get("content-type", "")),
+            background=BackgroundTask(result.aclose),
+        )
+        response.raw_headers.extend(copy_cache_headers(result.headers.raw))
+        return response
+    if result.status_code in (204, 304):
+        # Sin cuerpo: sólo estado y cabeceras de caché
+        response = Response(status_code=result.status_code)
+        response.raw_headers.extend(result.headers)
+        return response
+    response = Response(
+        content=result.content,
+        media_type=_media_type(result.content_type),
+        status_code=result.status_code,
+    )
+    response.raw_headers.extend(result.headers)
+    return response
+
+
+def purge_cache() -> int:
+    """Vacía la caché en memoria y devuelve cuántas entradas había"""
+    purged = len(_cache)
+    _cache.clear()
+    return purged
+
+
+def invalidate(url: str) -> int:
+    """Elimina de la caché las entradas de `url`, con cualquier query"""
+    keys = [key for key in _cache if key[0] == url]
+    for key in keys:
+        del _cache[key]
+    return len(keys)
@@ -46,7 +46,7 @@ fi
 python3 -m venv "${PY_ENV}"
 source "${PY_ENV}/bin/activate"
 pip install --upgrade pip
-pip install "fastapi" "uvicorn[standard]" "httpx"
+pip install "fastapi" "uvicorn[standard]" "httpx[http2]" "xxhash" "jinja2" "orjson"
 
 # --- Permitir bind a puerto 80 sin root ---
 # Damos capacidad al binario de Python del venv para puertos <1024
@@ -71,7 +71,7 @@ User=${APP_NAME}
 Group=${APP_NAME}
 WorkingDirectory=${APP_DIR}
 EnvironmentFile=${ENV_FILE}
-ExecStart=${PY_ENV}/bin/uvicorn app:app --host 0.0.0.0 --port 80 --workers 2
+ExecStart=${PY_ENV}/bin/uvicorn app:app --host 0.0.0.0 --port 80 --workers 2 --loop uvloop --http httptools
 Restart=on-failure
 RestartSec=3
 